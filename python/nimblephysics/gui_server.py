@@ -1,12 +1,19 @@
-from http.server import HTTPServer, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from http.server import HTTPServer, SimpleHTTPRequestHandler
 from http import HTTPStatus
+import socketserver
+import gzip
+import mimetypes
+import email.utils
+import functools
 import os
 import pathlib
 import nimblephysics as nimble
 import random
 import typing
 import threading
-from typing import Any, List
+import queue
+import hashlib
+from typing import Any, Dict, List, Optional, Tuple
 import torch
 import numpy as np
 import math
@@ -14,6 +21,10 @@ import pybullet as p
 import pybullet_data
 import time
 import logging
+try:
+  import xxhash
+except ImportError:
+  xxhash = None
 # from scipy.spatial.transform import Rotation
 # import pdb
 
@@ -27,22 +38,162 @@ console_handler.setFormatter(formatter)
 logger.addHandler(console_handler)
 logger.propagate = False
 
+# URL path -> (payload, gzipped payload or None, content type, mtime) for every file
+# in `file_path`. The web GUI is a small fixed bundle, so it's read once and served
+# from memory. Only text assets get a gzipped copy, images are already compressed.
+_ASSET_CACHE: Dict[str, Tuple[bytes, Optional[bytes], str, float]] = {}
+_COMPRESSIBLE_TYPES = {'application/javascript', 'application/json', 'application/xml', 'image/svg+xml'}
+
+
+def _loadAssetCache():
+  for root, _, files in os.walk(file_path):
+    for name in files:
+      full_path = os.path.join(root, name)
+      url_path = '/' + os.path.relpath(full_path, file_path).replace(os.sep, '/')
+      with open(full_path, 'rb') as f:
+        payload = f.read()
+      content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+      compressible = content_type.startswith('text/') or content_type in _COMPRESSIBLE_TYPES
+      gzipped = gzip.compress(payload) if compressible else None
+      _ASSET_CACHE[url_path] = (payload, gzipped, content_type, os.path.getmtime(full_path))
+  if '/index.html' in _ASSET_CACHE:
+    _ASSET_CACHE['/'] = _ASSET_CACHE['/index.html']
+
+
+def _acceptsGzip(acceptEncoding: str) -> bool:
+  """
+  Whether an Accept-Encoding header allows gzip, honoring q-values (so
+  `gzip;q=0` is a refusal) and letting an explicit `gzip` entry override `*`.
+  """
+  qualities = {}
+  for coding in acceptEncoding.split(','):
+    name, _, params = coding.partition(';')
+    name = name.strip().lower()
+    if name not in ('gzip', '*'):
+      continue
+    q = 1.0
+    for param in params.split(';'):
+      key, _, value = param.partition('=')
+      if key.strip().lower() == 'q':
+        try:
+          q = float(value)
+        except ValueError:
+          q = 0.0
+    qualities[name] = q
+  return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+def _compute_free_targets(state: np.ndarray, staticks: np.ndarray,
+                          init_pos: np.ndarray, init_angle: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+  """
+  Computes the base position (nfree, 3) and orientation quaternion (nfree, 4) of
+  every free joint in one pass. A free joint's state is [angle_change, pos_change],
+  added on top of the initial pose. The quaternion is the same as
+  p.getQuaternionFromEuler ([roll, pitch, yaw] -> [x, y, z, w], applied as
+  yaw * pitch * roll), but without the round trip into bullet.
+  """
+  nfree = staticks.shape[0]
+  pos = np.empty((nfree, 3))
+  quat = np.empty((nfree, 4))
+  for k in range(nfree):
+    tick = staticks[k]
+    for j in range(3):
+      pos[k, j] = init_pos[k, j] + state[tick + 3 + j]
+    half_roll = (init_angle[k, 0] + state[tick]) * 0.5
+    half_pitch = (init_angle[k, 1] + state[tick + 1]) * 0.5
+    half_yaw = (init_angle[k, 2] + state[tick + 2]) * 0.5
+    cr, cp, cy = math.cos(half_roll), math.cos(half_pitch), math.cos(half_yaw)
+    sr, sp, sy = math.sin(half_roll), math.sin(half_pitch), math.sin(half_yaw)
+    quat[k, 0] = sr * cp * cy - cr * sp * sy
+    quat[k, 1] = cr * sp * cy + sr * cp * sy
+    quat[k, 2] = cr * cp * sy - sr * sp * cy
+    quat[k, 3] = cr * cp * cy + sr * sp * sy
+  return pos, quat
+
+
+_free_targets_kernel = None
+
+
+def _getFreeTargetsKernel():
+  """
+  Returns _compute_free_targets compiled with numba if it's installed, or as
+  regular python otherwise. numba is only imported the first time this is called,
+  so `import nimblephysics` doesn't pay for it outside of bullet mode.
+  """
+  global _free_targets_kernel
+  if _free_targets_kernel is None:
+    try:
+      from numba import njit
+      _free_targets_kernel = njit(cache=True)(_compute_free_targets)
+    except ImportError:
+      _free_targets_kernel = _compute_free_targets
+  return _free_targets_kernel
+
+
+@functools.lru_cache(maxsize=None)
+def _deprecatedStub(name: str):
+  def deprecated_func(*args, **kwargs):
+    logger.warning(f"No need to call <{name}> in bullet vis mode")
+  return deprecated_func
+
+
 class DeprecatedClass:
-  def __getattribute__(self, __name: str) -> Any:
-    def deprecated_func(*args, **kwargs):
-      logger.warning(f"No need to call <{__name}> in bullet vis mode")
-    
+  # Only called for attributes that don't exist, so regular lookups stay fast.
+  # Doesn't touch any instance state, so it can't recurse into itself.
+  def __getattr__(self, __name: str) -> Any:
     if __name.startswith('__') and __name.endswith('__'):
-      return object.__getattribute__(self,__name)
-    else:
-      return deprecated_func
+      raise AttributeError(__name)
+    return _deprecatedStub(__name)
     
+class ThreadPoolHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+  """
+  Like ThreadingHTTPServer, but requests are handled on a fixed-size pool of
+  worker threads instead of spawning a new thread for every request. The workers
+  are daemon threads, so a connection that's still open never blocks exiting.
+  """
+  def __init__(self, server_address, RequestHandlerClass, max_workers: int):
+    super().__init__(server_address, RequestHandlerClass)
+    self._requests: queue.Queue = queue.Queue()
+    self._workers = [threading.Thread(target=self._workerLoop, daemon=True) for _ in range(max_workers)]
+    for worker in self._workers:
+      worker.start()
+
+  def _workerLoop(self):
+    while True:
+      item = self._requests.get()
+      if item is None:
+        return
+      self.process_request_thread(*item)
+
+  def process_request(self, request, client_address):
+    self._requests.put((request, client_address))
+
+  def server_close(self):
+    super().server_close()
+    # Drop requests that haven't started yet, and let the workers exit once idle
+    while True:
+      try:
+        item = self._requests.get_nowait()
+      except queue.Empty:
+        break
+      if item is not None:
+        self.shutdown_request(item[0])
+    for _ in self._workers:
+      self._requests.put(None)
+
+
 def createRequestHandler():
   """
   This creates a request handler that can serve the raw web GUI files, in
   addition to a configuration string of JSON.
   """
+  if not _ASSET_CACHE:
+    _loadAssetCache()
+
   class LocalHTTPRequestHandler(SimpleHTTPRequestHandler):
+    # Idle or slow connections (e.g. browser preconnects) give their worker back
+    # after this many seconds, instead of holding it forever
+    timeout = 10
+
     def __init__(self, *args, **kwargs):
       super().__init__(*args, directory=file_path, **kwargs)
 
@@ -58,7 +209,34 @@ def createRequestHandler():
       else:
           super().do_GET()
       """
-      super().do_GET()
+      path = self.path.split('?', 1)[0].split('#', 1)[0]
+      if path not in _ASSET_CACHE:
+        super().do_GET()
+        return
+      payload, gzipped, content_type, mtime = _ASSET_CACHE[path]
+      # Same conditional GET handling as SimpleHTTPRequestHandler.send_head()
+      if "If-Modified-Since" in self.headers and "If-None-Match" not in self.headers:
+        try:
+          ims = email.utils.parsedate_to_datetime(self.headers["If-Modified-Since"])
+        except (TypeError, IndexError, OverflowError, ValueError):
+          ims = None
+        if ims is not None and ims.tzinfo is not None and int(mtime) <= ims.timestamp():
+          self.send_response(HTTPStatus.NOT_MODIFIED)
+          self.end_headers()
+          return
+      useGzip = gzipped is not None and _acceptsGzip(self.headers.get('Accept-Encoding', ''))
+      if useGzip:
+        payload = gzipped
+      self.send_response(HTTPStatus.OK)
+      self.send_header("Content-type", content_type)
+      self.send_header("Content-Length", str(len(payload)))
+      self.send_header("Last-Modified", self.date_time_string(mtime))
+      if useGzip:
+        self.send_header("Content-Encoding", "gzip")
+      if gzipped is not None:
+        self.send_header("Vary", "Accept-Encoding")
+      self.end_headers()
+      self.wfile.write(payload)
   return LocalHTTPRequestHandler
 
 
@@ -74,7 +252,10 @@ class NimbleGUI:
       self.log_id = None
       self.saveCameraPath = None
       self.useSyntheticCamera = useSyntheticCamera
+      # Only capture a synthetic camera frame every `captureEvery` frames
+      self.captureEvery = 1
       self.headless = headless
+      self._saveThread = None
       self.render_bullet_init(worldToCopy)
       if videoLogFile is not None:
         video_log_dir = os.path.dirname(videoLogFile)
@@ -83,6 +264,11 @@ class NimbleGUI:
       if saveCameraPath is not None:
         self.saveCameraPath = os.path.abspath(saveCameraPath)
         os.makedirs(self.saveCameraPath, exist_ok=True)
+        # Camera frames are written to disk on a background thread, so np.save never
+        # stalls the render loop. The queue is bounded, and frames are dropped when it's full.
+        self._saveQueue: queue.Queue = queue.Queue(maxsize=4)
+        self._saveThread = threading.Thread(target=self._saveLoop, daemon=True)
+        self._saveThread.start()
       logger.info("Bullet GUI initialized")
     else:
       self.world = worldToCopy.clone()
@@ -94,8 +280,12 @@ class NimbleGUI:
       self.guiServer.registerConnectionListener(self._onConnect)
 
       self.looping = False
-      self.posMatrixToLoop = np.zeros((self.world.getNumDofs(), 0))
+      self._setLoopRows(np.zeros((0, self.world.getNumDofs())))
       self.i = 0
+      # Digest of the last trajectory sent with renderTrajectoryLines
+      self._lastTrajHash = None
+      # Number of worker threads serving the static web GUI files
+      self.http_threads = (os.cpu_count() or 4) + 2
 
   def serve(self, port):
     if self.useBullet:
@@ -103,7 +293,7 @@ class NimbleGUI:
       return
     self.guiServer.serve(8070)
     server_address = ('', port)
-    self.httpd = ThreadingHTTPServer(server_address, createRequestHandler())
+    self.httpd = ThreadPoolHTTPServer(server_address, createRequestHandler(), self.http_threads)
     print('Web GUI serving on http://localhost:'+str(port))
     t = threading.Thread(None, self.httpd.serve_forever)
     t.daemon = True
@@ -114,11 +304,17 @@ class NimbleGUI:
       if self.log_id is not None:
         p.stopStateLogging(self.log_id)
         logger.info("Video log saved")
+      if self._saveThread is not None and self._saveThread.is_alive():
+        # Let the writer thread finish the frames that are still queued
+        self._saveQueue.join()
+        self._saveQueue.put(None)
+        self._saveThread.join()
       p.disconnect()
       logger.info("Bullet GUI disconnected")
       return
     self.guiServer.stopServing()
     self.httpd.shutdown()
+    self.httpd.server_close()
 
   def displayState(self, state: torch.Tensor):
     self.looping = False
@@ -135,22 +331,59 @@ class NimbleGUI:
           time.sleep(0.1)
         if not indefinite:
           break
+      # Make sure every saved frame is on disk by the time we return
+      if self._saveThread is not None:
+        self._saveQueue.join()
+      return
+    if not states:
       return
     self.looping = True
     self.statesToLoop = states
     dofs = self.world.getNumDofs()
-    poses = np.zeros((dofs, len(states)))
-    for i in range(len(states)):
-      # Take the top-half of each state vector, since this is the position component
-      poses[:, i] = states[i].detach().numpy()[:dofs]
-    self.guiServer.renderTrajectoryLines(self.world, poses)
-    self.posMatrixToLoop = poses
+    # Take the top-half of each state vector, since this is the position component.
+    # Stacking once copies all states in a single pass, straight into the
+    # (N, dofs) row layout we loop over, so no further copies are needed.
+    rows = np.asarray(torch.stack([state.detach()[:dofs] for state in states]).cpu().numpy(), dtype=np.float64)
+    self._renderTrajectoryLines(rows)
+    self._setLoopRows(rows)
 
   def loopPosMatrix(self, poses: np.ndarray):
     self.looping = True
-    self.guiServer.renderTrajectoryLines(self.world, poses)
-    # It's important to make a copy, because otherwise we get a reference to internal C++ memory that gets cleared
-    self.posMatrixToLoop = np.copy(poses)
+    rows = np.ascontiguousarray(poses.T)
+    # It's important to make a copy if this is still a view of memory we don't own,
+    # because otherwise we get a reference to internal C++ memory that gets cleared
+    base = rows
+    while isinstance(base.base, np.ndarray):
+      base = base.base
+    if not base.flags.owndata:
+      rows = rows.copy()
+    self._renderTrajectoryLines(rows)
+    self._setLoopRows(rows)
+
+  def _renderTrajectoryLines(self, rows: np.ndarray):
+    # Re-looping the same trajectory is common, so skip re-uploading the whole
+    # matrix over the websocket if it hasn't changed. Hashing is cheap next to the send,
+    # and both hashes read the contiguous buffer directly without copying it.
+    # The lines live in the C++ GUI state, so this can only tell they're still there
+    # as long as nobody touched the server behind our back, see nativeAPI().
+    if xxhash is not None:
+      h = xxhash.xxh3_128_digest(rows)
+    else:
+      h = hashlib.blake2b(rows, digest_size=16).digest()
+    h = (rows.shape, rows.dtype.str, h)
+    if h == self._lastTrajHash:
+      return
+    self.guiServer.renderTrajectoryLines(self.world, rows.T)
+    self._lastTrajHash = h
+
+  def _setLoopRows(self, rows: np.ndarray):
+    # Frames are stored as contiguous (N, dofs) rows, so picking one out per tick is
+    # a single contiguous read instead of a strided column slice. posMatrixToLoop is
+    # only a (dofs, N) view of the same buffer.
+    self._loopRows = rows
+    self.posMatrixToLoop = rows.T
+    # Cached so _onTick doesn't have to go through numpy to get the length
+    self._loopLen = rows.shape[0]
 
   def stopLooping(self):
     self.looping = False
@@ -159,6 +392,10 @@ class NimbleGUI:
     if self.useBullet:
       print("No need to call this function for bullet")
       return DeprecatedClass()
+    # Callers can clear() or delete our trajectory lines through the raw server, so
+    # the next loop has to upload them again. A server reference kept from an earlier
+    # call can still do this unnoticed, so call nativeAPI() again instead.
+    self._lastTrajHash = None
     return self.guiServer
 
   def blockWhileServing(self):
@@ -168,8 +405,9 @@ class NimbleGUI:
 
   def _onTick(self, now):
     if self.looping:
-      if self.i < np.shape(self.posMatrixToLoop)[1]:
-        self.world.setPositions(self.posMatrixToLoop[:, self.i])
+      if self.i < self._loopLen:
+        # The websocket server already batches these on its own flush thread
+        self.world.setPositions(self._loopRows[self.i])
         self.guiServer.renderWorld(self.world)
         self.i += 1
       else:
@@ -179,17 +417,28 @@ class NimbleGUI:
     p.resetSimulation()
     self.world = world
     self.skeleton_to_bullet_id = {}
-    self.init_pos_rot = {}
-    self.joint_to_state = []
+    # Flat per-joint plan walked by bullet_loopState, so the per-frame path never
+    # has to go back to the world or do any dict lookups:
+    # [p_id, staTick (into the full state), dof, bullet_joint_idx]
+    self._plan: List[Tuple[int, int, int, int]] = []
+    # Free joints are kept as parallel arrays, so their targets can all be computed
+    # in one go by _compute_free_targets
+    free_pids, free_staticks, free_init_pos, free_init_angle = [], [], [], []
+    # 1-DoF joints are not in the plan, they get reset in one batched call per body:
+    # bullet joint indices, and the matching indices into the full state
+    self._1dof_indices: typing.Dict[int, List[int]] = {}
+    self._1dof_gather: typing.Dict[int, np.ndarray] = {}
+    # Where the current skeleton starts in the full state
+    global_tick = 0
 
-    for i in range(world.getNumSkeletons()):
-      skeleton = world.getSkeleton(i)
+    for i_skel in range(world.getNumSkeletons()):
+      skeleton = world.getSkeleton(i_skel)
       urdf_path = skeleton.getURDFPath()
       pos = skeleton.getBasePos()
       rot = skeleton.getEulerAngle()
       rot_quat = p.getQuaternionFromEuler(rot)
 
-      logger.debug(f"Start loading URDF, {i}")
+      logger.debug(f"Start loading URDF, {i_skel}")
       bullet_id = p.loadURDF(urdf_path, pos, rot_quat)
       logger.debug(f"URDF path: {urdf_path}")
       self.skeleton_to_bullet_id[skeleton.getName()] = bullet_id
@@ -199,13 +448,15 @@ class NimbleGUI:
       # rot = Rotation.from_matrix(skeleton.getRootBodyNode().getTransform().rotation())
       # rot = rot.as_euler('xyz', degrees=False)
       # print('init pos rot',pos, rot)
-      self.init_pos_rot[skeleton.getName()] = (pos, rot) 
+      init_pos = np.asarray(pos, dtype=np.float64)
+      init_angle = np.asarray(rot, dtype=np.float64)
       
-      # [isFreeJoint, staTick, dof, bullet_joint_idx, nimble_joint_idx (not used)] 
-      self.joint_to_state.append([])
       skeleton_joints = [skeleton.getJoint(i) for i in range(skeleton.getNumJoints())]
-      bullet_joint_name_idx = {p.getJointInfo(bullet_id, i)[1].decode('utf-8'): i for i in range(p.getNumJoints(bullet_id))}
+      # Bullet hands back joint names as bytes, so keep them that way and encode our
+      # side instead of decoding every bullet joint name
+      bullet_joint_name_idx = {p.getJointInfo(bullet_id, i)[1]: i for i in range(p.getNumJoints(bullet_id))}
       tick = 0
+      gather = []
       for i, joint in enumerate(skeleton_joints):
         joint_type = joint.getType()
         # Nothing to do for fixed joints
@@ -214,21 +465,39 @@ class NimbleGUI:
         
         dof = joint.NumDofs
         name = joint.getName()
+        name_bytes = name.encode('utf-8')
         # Most likely world to base joint
         if joint_type == 'FreeJoint':
-          if name in bullet_joint_name_idx:
+          if name_bytes in bullet_joint_name_idx:
             print(f'FreeJoint {name} is found in bullet, treated as object to world joint')
           isFreeJoint = True
           bullet_joint_idx = None
           
         # Other joints
         else:
-          assert name in bullet_joint_name_idx, f'{name} is not found in bullet, check urdf'
+          assert name_bytes in bullet_joint_name_idx, f'{name} is not found in bullet, check urdf'
           isFreeJoint = False
-          bullet_joint_idx = bullet_joint_name_idx[name]
+          bullet_joint_idx = bullet_joint_name_idx[name_bytes]
           
-        self.joint_to_state[-1].append([isFreeJoint, tick, dof, bullet_joint_idx, i])
+        staTick = global_tick + tick
+        if isFreeJoint:
+          free_pids.append(bullet_id)
+          free_staticks.append(staTick)
+          free_init_pos.append(init_pos)
+          free_init_angle.append(init_angle)
+        elif dof == 1:
+          self._1dof_indices.setdefault(bullet_id, []).append(bullet_joint_idx)
+          gather.append(staTick)
+        else:
+          self._plan.append((bullet_id, staTick, dof, bullet_joint_idx))
         tick += dof
+      if gather:
+        self._1dof_gather[bullet_id] = np.array(gather, dtype=np.int64)
+      global_tick += skeleton.getNumDofs()
+    self._free_pids = free_pids
+    self._free_staticks = np.array(free_staticks, dtype=np.int64)
+    self._free_init_pos = np.array(free_init_pos, dtype=np.float64).reshape(-1, 3)
+    self._free_init_angle = np.array(free_init_angle, dtype=np.float64).reshape(-1, 3)
       
   def render_bullet_init(self, world):
     self.p = p
@@ -241,16 +510,18 @@ class NimbleGUI:
     
     if self.useSyntheticCamera:
       logger.info("Enable synthetic camera")
-      p.configureDebugVisualizer(p.COV_ENABLE_SEGMENTATION_MARK_PREVIEW, 1)
-      p.configureDebugVisualizer(p.COV_ENABLE_DEPTH_BUFFER_PREVIEW, 1)
-      p.configureDebugVisualizer(p.COV_ENABLE_RGB_BUFFER_PREVIEW, 1)
+      for flag in (p.COV_ENABLE_SEGMENTATION_MARK_PREVIEW,
+                   p.COV_ENABLE_DEPTH_BUFFER_PREVIEW,
+                   p.COV_ENABLE_RGB_BUFFER_PREVIEW):
+        p.configureDebugVisualizer(flag, 1)
     else:
       logger.info("Disable synthetic camera")
       p.configureDebugVisualizer(p.COV_ENABLE_GUI, 0)
       
     p.setAdditionalSearchPath(pybullet_data.getDataPath())
 
-    p.setTimeStep(0.01)
+    # All one-shot engine config lives here, keep it out of the per-frame path
+    p.setPhysicsEngineParameter(fixedTimeStep=0.01)
     p.setGravity(0, 0, 0)
 
     logger.info("Load world")
@@ -261,61 +532,68 @@ class NimbleGUI:
     # self.bullet_auto_camera()
     
   def bullet_loopState(self, state, save_idx):
-    tick = 0
-    for skeleton_idx in range(self.world.getNumSkeletons()):
-      logger.debug(f'bullet_loopState: skeleton_idx = {skeleton_idx}')
-      skeleton = self.world.getSkeleton(skeleton_idx)
-      dof = skeleton.getNumDofs()
-      if dof == 0:
-        continue
-
-      p_id = self.skeleton_to_bullet_id[skeleton.getName()]
-      actions = state[tick: tick+dof]
-      for joint_info in self.joint_to_state[skeleton_idx]:
-        isFreeJoint, staTick, joint_dof, bullet_joint_idx, nimble_joint_idx = joint_info
-        logger.debug(f'bullet_loopState: joint_info = {joint_info}')
-        if isFreeJoint:
-          action = actions[staTick: staTick+joint_dof]
-          init_pos, init_angle = self.init_pos_rot[skeleton.getName()]
-          pos_change, angle_change = np.array(action[3:]), np.array(action[:3])
-          logger.debug(f'{p_id}: name = {skeleton.getName()}, pos = {pos_change} + {init_pos}, angle = {init_angle} + {angle_change}')
-          # print(state, tick, dof, staTick, joint_dof, actions, action)
-          p.resetBasePositionAndOrientation(p_id, pos_change + init_pos,
-                                            p.getQuaternionFromEuler(init_angle + angle_change))
-          continue
-        
-        if joint_dof == 1:
-          p.resetJointState(p_id, bullet_joint_idx, actions[staTick])
-          logger.debug(f'{p_id}: name = {skeleton.getName()}, joint = {p.getJointInfo(p_id, bullet_joint_idx)[1].decode("utf-8")}, action = {actions[staTick]}')
-        else:
-          p.resetJointStateMultiDof(p_id, bullet_joint_idx, actions[staTick: staTick+joint_dof])
-          logger.debug(f'{p_id}: name = {skeleton.getName()}, joint = {p.getJointInfo(p_id, bullet_joint_idx)[1].decode("utf-8")}, action = {actions[staTick: staTick+dof]}')
-          
-      tick += dof
+    # Convert once up front, so every joint below only takes cheap numpy views
+    state = state.detach().cpu().numpy() if torch.is_tensor(state) else np.asarray(state, dtype=np.float64)
+    # Checked once per frame, so the per-joint f-strings are never built at INFO
+    _DEBUG = logger.isEnabledFor(logging.DEBUG)
+    if self._free_pids:
+      positions, quats = _getFreeTargetsKernel()(state, self._free_staticks,
+                                                 self._free_init_pos, self._free_init_angle)
+      for p_id, new_pos, new_quat in zip(self._free_pids, positions.tolist(), quats.tolist()):
+        if _DEBUG:
+          logger.debug(f'{p_id}: pos = {new_pos}, quat = {new_quat}')
+        p.resetBasePositionAndOrientation(p_id, new_pos, new_quat)
+    for p_id, staTick, joint_dof, bullet_joint_idx in self._plan:
+      p.resetJointStateMultiDof(p_id, bullet_joint_idx, state[staTick: staTick+joint_dof])
+    for p_id, indices in self._1dof_indices.items():
+      values = state[self._1dof_gather[p_id]].tolist()
+      p.resetJointStatesMultiDof(p_id, indices, [[v] for v in values])
     
-    if self.useSyntheticCamera:
+    # A headless capture that isn't saved would just be thrown away
+    capture = self.useSyntheticCamera and (self.saveCameraPath is not None or not self.headless)
+    if capture and (save_idx is None or save_idx % self.captureEvery == 0):
+      save = (self.saveCameraPath is not None) and (save_idx is not None)
       img = p.getCameraImage(640, 480, renderer=p.ER_BULLET_HARDWARE_OPENGL)
-      if (self.saveCameraPath is not None) and (save_idx is not None):
-        rgb = img[2]
-        depth = img[3]
-        segmentation = img[4]
-        rgb = np.reshape(rgb, (480, 640, 4))
-        depth = np.reshape(depth, (480, 640))
-        segmentation = np.reshape(segmentation, (480, 640))
+      if save:
+        # These are already numpy arrays when bullet is built with numpy, in which
+        # case this is just a view. The writer thread owns them once queued, so we
+        # don't reuse buffers across frames.
+        rgb = np.asarray(img[2], dtype=np.uint8).reshape(480, 640, 4)
+        depth = np.asarray(img[3], dtype=np.float32).reshape(480, 640)
+        segmentation = np.asarray(img[4], dtype=np.int32).reshape(480, 640)
+        try:
+          self._saveQueue.put_nowait((save_idx, rgb, depth, segmentation))
+        except queue.Full:
+          logger.warning(f"Camera save queue is full, dropping frame {save_idx}")
+
+  def _saveLoop(self):
+    while True:
+      item = self._saveQueue.get()
+      if item is None:
+        self._saveQueue.task_done()
+        return
+      save_idx, rgb, depth, segmentation = item
+      try:
         np.save(os.path.join(self.saveCameraPath, f'rgb_{save_idx}.npy'), rgb)
         np.save(os.path.join(self.saveCameraPath, f'depth_{save_idx}.npy'), depth)
         np.save(os.path.join(self.saveCameraPath, f'segmentation_{save_idx}.npy'), segmentation)
+      except Exception:
+        # Keep the writer alive, so later frames still get saved and shutdown can't hang
+        logger.exception(f"Failed to save camera frame {save_idx}")
+      finally:
+        self._saveQueue.task_done()
 
   def bullet_auto_camera(self):
-    inf = float('inf')
-    aabb_mins, aabb_maxs = [inf, inf, inf], [-inf, -inf, -inf]
-    for p_id in self.skeleton_to_bullet_id.values():
-      aabb = p.getAABB(p_id)
-      logger.debug(f'p_id = {p_id}, aabb = {aabb}')
-      aabb_mins = [min(aabb_mins[i], aabb[0][i]) for i in range(3)]
-      aabb_maxs = [max(aabb_maxs[i], aabb[1][i]) for i in range(3)]
-    center = [(aabb_mins[i] + aabb_maxs[i]) / 2 for i in range(3)]
-    diagonal = sum([(aabb_maxs[i] - aabb_mins[i]) ** 2 for i in range(3)]) ** 0.5
+    if not self.skeleton_to_bullet_id:
+      logger.warning("No bodies loaded, can't place the camera automatically")
+      return
+    # (N, 2, 3): the [min, max] corners of every body's AABB
+    aabbs = np.array([p.getAABB(p_id) for p_id in self.skeleton_to_bullet_id.values()], dtype=np.float64)
+    logger.debug(f'aabbs = {aabbs}')
+    aabb_mins = aabbs[:, 0].min(axis=0)
+    aabb_maxs = aabbs[:, 1].max(axis=0)
+    center = ((aabb_mins + aabb_maxs) * 0.5).tolist()
+    diagonal = float(np.linalg.norm(aabb_maxs - aabb_mins))
     camera_dist = diagonal * 2
     camera_yaw, camera_pitch = 40, -20
     logger.info("camera_dist = {}, camera_yaw = {}, camera_pitch = {}, center = {}".format(